@@ -1,14 +1,30 @@
 #!/usr/bin/env python
-import warnings
+import hashlib
+import os
 from abc import ABC
+from contextlib import suppress
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path as P
-from textwrap import dedent
 
+import music21
 from music21 import *
 
+__all__ = [
+    "SCORE_NAME",
+    "CodegenContext",
+    "ContainerHandler",
+    "ElementHandler",
+    "generate_code_for_music_structure",
+    "generate_code_lines",
+    "register",
+]
+
 SCORE_NAME = "score"
-HANDLES_ATTR = "handles"
+_MODULE_NAME = P(__file__).name
+_MISS = object()  # sentinel for lookups where None is a legitimate value
+_CACHE_ENTRIES = 64  # generated scripts kept in the cache of the command line
 
 if __name__ == "__main__":
     import sys
@@ -38,41 +54,40 @@ Score
         └── TimeSignature
 """
 
-resolve_spanners = ""
+
+@dataclass
+class CodegenContext:
+    """
+    State of one generate_code_for_music_structure call, passed down to every
+    handler. Keeping it out of module globals makes the generator reentrant.
+    """
+
+    # lines resolving the spanners, to be emitted once all notes are generated
+    resolve_lines: list[str] = field(default_factory=list)
 
 
 class ElementHandler(ABC):
-    handles = None
+    __slots__ = ()
+    handles = None  # the music21-class handled, set by register
     insert = False  # by default, do not insert at the beginning of container
+    _PROPERTIES = ()  # names of the properties emitted, see get_properties
     _handlers = {}
+    _resolved = {}  # concrete element type -> handler (or None), filled lazily
 
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
-        if hasattr(cls, HANDLES_ATTR):
-            if cls.handles:
-                ElementHandler._handlers[cls.handles] = cls()
-            elif cls.__name__ != "ContainerHandler":
-                warnings.warn(
-                    f"Subclass {cls.__name__} has no {HANDLES_ATTR} attribute set. It will not be registered."
-                )
-        elif (
-            cls.__name__ != "ContainerHandler"
-        ):  # using string here, otherwise ContainerHandler is not defined yet
-            warnings.warn(
-                f"Subclass {cls.__name__} is missing a {HANDLES_ATTR} attribute and will not be registered."
-            )
-
-    def generate_code(self, element, name: str) -> str:
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         """
         May be implemented by subclasses.
-        Returns a tuple: the code to generate this element and True if the element should be inserted
-                         at the beginning, False if at the end of its container.
+        Appends the code to generate this element to code_lines. Whether the element
+        is inserted at the beginning or appended at the end of its container is
+        governed by the class attribute insert. Code that has to run after the
+        whole structure is generated goes to ctx.
         """
         params = self.get_params(element)
-        code_lines = [f"{name} = {self.get_hcls()}({params})"]
+        code_lines.append(f"{name} = {self._hcls_str}({params})")
         if ct := self.custom_treatment(element, name):
             code_lines.extend(ct)
-        return "\n".join(code_lines)
 
     def custom_treatment(self, element, name: str) -> list[str]:
         return []
@@ -81,344 +96,440 @@ class ElementHandler(ABC):
         params = []
         for prop in self.get_properties():
             if (value := getattr(element, prop, None)) is not None:
-                params.append(f"{prop}='{value}'")
+                params.append(f"{prop}={str(value)!r}")
 
         return ", ".join(params)
 
-    def get_properties(self) -> list[str]:
-        return []
+    def get_properties(self) -> tuple[str, ...]:
+        return self._PROPERTIES
 
     @classmethod
     def get_handler(cls, element):
-        element_type = type(element)
-        while element_type is not None:
-            if handler := cls._handlers.get(element_type):
-                return handler
-            # Move up the inheritance hierarchy
-            element_type = element_type.__base__
-        return None
+        handler = cls._resolved.get(element_type := type(element), _MISS)
+        if handler is _MISS:
+            handler = None
+            # Move up the inheritance hierarchy, once per concrete type
+            for base in element_type.__mro__:
+                if (handler := cls._handlers.get(base)) is not None:
+                    break
+            cls._resolved[element_type] = handler
+        return handler
+
+    @classmethod
+    def registered(cls) -> None:
+        """
+        May be implemented by subclasses to precompute per-class data.
+        Called by register, once handles is set.
+        """
 
     @classmethod
     def get_hcls(cls):
         """
         Gets the music21-class handled by this Handler as string, stripped of
-        top level module "music21".
+        top level module "music21". Computed once on registration, see
+        register.
         """
-        h = cls.handles
-        return f"{h.__module__[h.__module__.index('.') + 1:]}.{h.__qualname__}"
+        return cls._hcls_str
+
+
+def register(handles):
+    """
+    Class decorator registering an ElementHandler subclass as the handler for the
+    music21-class handles (and its subclasses, unless they have a handler of their
+    own).
+    """
+
+    def decorator(cls):
+        cls.handles = handles
+        cls._hcls_str = (
+            f"{handles.__module__[handles.__module__.index('.') + 1:]}"
+            f".{handles.__qualname__}"
+        )
+        cls.registered()
+        ElementHandler._handlers[handles] = cls()
+        ElementHandler._resolved.clear()
+        return cls
+
+    return decorator
 
 
+def _no_handler_error(element, container: str) -> NotImplementedError:
+    element_type = type(element)
+    return NotImplementedError(
+        f"\n\nNo handler implemented for sub-element type {element_type} in {container}."
+        f"\n\nGo ahead and contribute class {element_type.__name__}Handler(ElementHandler)!"
+        "\n\n"
+    )
+
+
+# Music is repetitive: the same (pitch, quarterLength) combinations recur throughout
+# a score, so the parameter strings of the most frequent leaf elements are cached.
+@lru_cache(maxsize=4096)
+def _note_params(pitch: str, ql) -> str:
+    return "".join((repr(pitch), ", duration=duration.Duration(", str(ql), ")"))
+
+
+@lru_cache(maxsize=4096)
+def _chord_params(pitches: tuple[str, ...], ql) -> str:
+    pitches = ", ".join(map(repr, pitches))
+    return "".join(("[", pitches, "], duration=duration.Duration(", str(ql), ")"))
+
+
+@lru_cache(maxsize=256)
+def _rest_params(ql) -> str:
+    return "".join(("duration=duration.Duration(", str(ql), ")"))
+
+
+@register(note.Note)
 class NoteHandler(ElementHandler):
-    handles = note.Note
+    __slots__ = ()
 
-    def generate_code(self, element, name: str) -> str:
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         params = self.get_params(element)
-        code = dedent(
-            f"""
-        {name} = {self.get_hcls()}({params})
-        generated_notes['{element.id}'] = {name}
-        """
-        )
+        code_lines.append(f"{name} = {self._hcls_str}({params})")
+        code_lines.append(f"generated_notes['{element.id}'] = {name}")
         if element.lyric:
-            # had to dedent manually, because there were multiline lyrics.
-            code += f"""
-{name}.lyric = '''{element.lyric}'''
-        """
-        return code
+            code_lines.append(f"{name}.lyric = {element.lyric!r}")
 
     def get_params(self, element) -> str:
-        return f"'{element.pitch}', duration=duration.Duration({element.duration.quarterLength})"
+        return _note_params(str(element.pitch), element.duration.quarterLength)
 
 
+@register(chord.Chord)
 class ChordHandler(ElementHandler):
-    handles = chord.Chord
+    __slots__ = ()
 
     def get_params(self, element) -> str:
-        pitches = ", ".join([f"'{p}'" for p in element.pitches])
-        return (
-            f"[{pitches}], duration=duration.Duration({element.duration.quarterLength})"
-        )
+        pitches = tuple(map(str, element.pitches))
+        return _chord_params(pitches, element.duration.quarterLength)
 
 
+@register(harmony.ChordSymbol)
 class ChordSymbolHandler(ElementHandler):
-    handles = harmony.ChordSymbol
+    __slots__ = ()
 
     def get_params(self, element) -> str:
-        return f"'{element.figure}'"  # Get the chord symbol as a string, e.g., "Cmaj7"
+        return repr(element.figure)  # Get the chord symbol as a string, e.g., "Cmaj7"
 
 
+@register(meter.TimeSignature)
 class TimeSignatureHandler(ElementHandler):
-    handles = meter.TimeSignature
+    __slots__ = ()
 
     def get_params(self, element) -> str:
-        return f"'{element.ratioString}'"
+        return repr(element.ratioString)
 
 
+def _all_subclasses(cls) -> list[type]:
+    subclasses = []
+    for subclass in cls.__subclasses__():
+        subclasses.append(subclass)
+        subclasses.extend(_all_subclasses(subclass))
+    return subclasses
+
+
+def _constructor_calls(module_name: str, cls) -> dict[type, str]:
+    """
+    Maps cls and all its subclasses known at import time to the code calling their
+    constructor, e.g. clef.TrebleClef -> "clef.TrebleClef()".
+    """
+    return {c: f"{module_name}.{c.__name__}()" for c in [cls, *_all_subclasses(cls)]}
+
+
+@register(clef.Clef)
 class ClefHandler(ElementHandler):
-    handles = clef.Clef
+    __slots__ = ()
+    _constructors = _constructor_calls("clef", clef.Clef)
 
-    def generate_code(self, element, name: str) -> str:
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         """
         Can't use the generic generate_code, because we're messing with the choice
         of constructor.
         """
-        return f"{name} = clef.{type(element).__name__}()"
+        clef_cls = type(element)
+        if not (constructor := self._constructors.get(clef_cls)):
+            constructor = f"clef.{clef_cls.__name__}()"
+            self._constructors[clef_cls] = constructor
+        code_lines.append(f"{name} = {constructor}")
 
 
+@register(key.KeySignature)
 class KeySignatureHandler(ElementHandler):
-    handles = key.KeySignature
+    __slots__ = ()
 
     def get_params(self, element) -> str:
         return f"{element.sharps}"
 
 
+@register(bar.Barline)
 class BarlineHandler(ElementHandler):
-    handles = bar.Barline
+    __slots__ = ()
 
     def get_params(self, element) -> str:
-        return f"'{element.type}'"
+        return repr(element.type)
 
 
+@register(instrument.Instrument)
 class InstrumentHandler(ElementHandler):
-    handles = instrument.Instrument
+    __slots__ = ()
     insert = True
+    _constructors = _constructor_calls("instrument", instrument.Instrument)
 
-    def generate_code(self, element, name: str) -> str:
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         """
         Can't use the generic generate_code, because we're messing with the choice
         of constructor.
         """
-        instrument_name = type(element).__name__
-        return f"{name} = instrument.{instrument_name}()"
+        instrument_cls = type(element)
+        if not (constructor := self._constructors.get(instrument_cls)):
+            constructor = f"instrument.{instrument_cls.__name__}()"
+            self._constructors[instrument_cls] = constructor
+        code_lines.append(f"{name} = {constructor}")
 
 
+@register(tempo.MetronomeMark)
 class MetronomeMarkHandler(ElementHandler):
-    handles = tempo.MetronomeMark
+    __slots__ = ()
 
-    def generate_code(self, element, name: str) -> str:
-        """ """
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         params = self.get_params(element)
-        placement = element.placement if hasattr(element, "placement") else "above"
-        return dedent(
-            f"""
-            {name} = {self.get_hcls()}({params})
-            {name}.placement = '{placement}'
-            """
-        )
+        placement = getattr(element, "placement", "above")
+        code_lines.append(f"{name} = {self._hcls_str}({params})")
+        code_lines.append(f"{name}.placement = '{placement}'")
 
     def get_params(self, element) -> str:
-        params = []
-
-        # Check for number attribute or derived tempo
-        tempo_number = getattr(element, "number", None)
-        if tempo_number is None and hasattr(element, "_tempo"):
-            tempo_number = element._tempo
-
-        if tempo_number is not None:
-            params.append(f"number={tempo_number}")
-
-        # Check for text attribute
-        if element.text:
-            params.append(f"text='{element.text}'")
-
-        # Check for referent attribute
-        if element.referent:
-            referent_type = element.referent.type
-            params.append(f"referent=duration.Duration(type='{referent_type}')")
-
-        return ", ".join(params)
+        # number is None for marks that only carry a text, fall back to derived tempo
+        if (number := element.number) is None:
+            number = getattr(element, "_tempo", None)
+        text = element.text
+        referent = element.referent
+        params = (
+            f"number={number}" if number is not None else None,
+            f"text={text!r}" if text else None,
+            f"referent=duration.Duration(type='{referent.type}')" if referent else None,
+        )
+        return ", ".join(filter(None, params))
 
 
+@register(layout.StaffLayout)
 class StaffLayoutHandler(ElementHandler):
-    handles = layout.StaffLayout
-
-    def get_properties(self) -> list[str]:
-        return "staffDistance staffNumber staffLines".split()
+    __slots__ = ()
+    _PROPERTIES = ("staffDistance", "staffNumber", "staffLines")
 
 
+@register(metadata.Metadata)
 class MetadataHandler(ElementHandler):
-    handles = metadata.Metadata
+    __slots__ = ()
     insert = True
-
-    def get_properties(self) -> list[str]:
-        return "title composer lyricist".split()
+    _PROPERTIES = ("title", "composer", "lyricist")
 
 
+@register(note.Rest)
 class RestHandler(ElementHandler):
-    handles = note.Rest
+    __slots__ = ()
 
     def get_params(self, element) -> str:
-        return f"duration=duration.Duration({element.duration.quarterLength})"
-
-
+        return _rest_params(element.duration.quarterLength)
+
+
+# Types whose repr() is a valid Python literal (lists only hold strings here)
+_LITERAL_TYPES = (int, float, str, bool, list)
+
+# The public TextStyle properties that hold literal values. Probing these few names
+# replaces scanning dir() of every TextBox style, and skips the private attributes
+# backing the properties.
+_TEXTSTYLE_PROPS = (
+    "absoluteX",
+    "absoluteY",
+    "alignHorizontal",
+    "alignVertical",
+    "color",
+    "dashLength",
+    "fontFamily",
+    "fontSize",
+    "fontStyle",
+    "fontWeight",
+    "hideObjectOnPrint",
+    "justify",
+    "language",
+    "letterSpacing",
+    "lineHeight",
+    "relativeX",
+    "relativeY",
+    "spaceLength",
+    "textDecoration",
+    "textDirection",
+    "textRotation",
+    "units",
+)
+
+
+@register(text.TextBox)
 class TextBoxHandler(ElementHandler):
-    handles = text.TextBox
+    __slots__ = ()
     insert = True
 
-    def generate_code(self, element, name: str) -> str:
-        content = element.content.replace("'", "\\'")
-
-        style_code = ""
-        if element.style:
-            style_code += f"{name}_style = style.TextStyle()\n"
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        code_lines.append(f"{name} = {self._hcls_str}(content={element.content!r})")
 
-            # Function to check if an attribute is scalar
-            def is_scalar(attr):
-                return isinstance(attr, (int, float, str, bool))
+        if element_style := element.style:
+            code_lines.append(f"{name}_style = style.TextStyle()")
 
-            # Iterate over attributes and handle only scalar values
-            for attr in dir(element.style):
-                if not attr.startswith("__") and not callable(
-                    getattr(element.style, attr)
-                ):
-                    value = getattr(element.style, attr)
-                    if is_scalar(value):
-                        # String values need to be quoted
-                        if isinstance(value, str):
-                            value = f"'{value}'"
-                        style_code += f"{name}_style.{attr} = {value}\n"
+            for attr in _TEXTSTYLE_PROPS:
+                value = getattr(element_style, attr, None)
+                if isinstance(value, _LITERAL_TYPES):
+                    code_lines.append(f"{name}_style.{attr} = {value!r}")
 
-            style_code += f"{name}.style = {name}_style\n"
-
-        return f"{name} = {self.get_hcls()}(content='{content}')\n{style_code}"
+            code_lines.append(f"{name}.style = {name}_style")
 
 
+@register(layout.ScoreLayout)
 class ScoreLayoutHandler(ElementHandler):
-    handles = layout.ScoreLayout
+    __slots__ = ()
     insert = True
-
-    def get_properties(self) -> list[str]:
-        return "staffDistance".split()
+    _PROPERTIES = ("staffDistance",)
 
 
+@register(layout.SystemLayout)
 class SystemLayoutHandler(ElementHandler):
-    handles = layout.SystemLayout
+    __slots__ = ()
     insert = True
+    _PROPERTIES = ("systemDistance", "topSystemDistance")
 
-    def generate_code(self, element, name: str) -> str:
-        code_lines = [f"{name} = {self.get_hcls()}(isNew={element.isNew})"]
-
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        code_lines.append(f"{name} = {self._hcls_str}(isNew={element.isNew})")
         code_lines.extend(self.get_lines(element, name))
 
-        return "\n".join(code_lines)
-
-    def get_lines(self, element, name) -> str:
-        code_lines = []
-        for prop in self.get_properties():
-            if (value := getattr(element, prop, None)) is not None:
-                code_lines.append(f"{name}.{prop}='{value}'")
-
-        return code_lines
-
-    def get_properties(self) -> list[str]:
-        return "systemDistance topSystemDistance".split()
+    def get_lines(self, element, name) -> list[str]:
+        return [
+            f"{name}.{prop}={str(value)!r}"
+            for prop in self.get_properties()
+            if (value := getattr(element, prop, None)) is not None
+        ]
 
 
+@register(layout.PageLayout)
 class PageLayoutHandler(ElementHandler):
-    handles = layout.PageLayout
+    __slots__ = ()
     insert = True
+    _PROPERTIES = (
+        "leftMargin",
+        "rightMargin",
+        "topMargin",
+        "bottomMargin",
+        "pageHeight",
+        "pageWidth",
+        "isPortrait",
+        # Add more properties here as needed
+    )
 
-    def generate_code(self, element, name: str) -> str:
-        code_lines = [f"{name} = {self.get_hcls()}()"]
-
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        code_lines.append(f"{name} = {self._hcls_str}()")
         code_lines.extend(self.get_lines(element, name))
 
-        return "\n".join(code_lines)
-
-    def get_lines(self, element, name) -> str:
-        code_lines = []
-        for prop in self.get_properties():
-            if (value := getattr(element, prop, None)) is not None:
-                code_lines.append(f"{name}.{prop}='{value}'")
-
-        return code_lines
-
-    def get_properties(self) -> list[str]:
+    def get_lines(self, element, name) -> list[str]:
         return [
-            "leftMargin",
-            "rightMargin",
-            "topMargin",
-            "bottomMargin",
-            "pageHeight",
-            "pageWidth",
-            "isPortrait",
-            # Add more properties here as needed
+            f"{name}.{prop}={str(value)!r}"
+            for prop in self.get_properties()
+            if (value := getattr(element, prop, None)) is not None
         ]
 
 
+@register(expressions.TextExpression)
 class TextExpressionHandler(ElementHandler):
-    handles = expressions.TextExpression
+    __slots__ = ()
 
-    def generate_code(self, element, name: str) -> str:
-        # Escape single quotes in the text content
-        content = element.content.replace("'", "\\'")
-        return f"{name} = {self.get_hcls()}('{content}')\n"
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        code_lines.append(f"{name} = {self._hcls_str}({element.content!r})")
 
 
+@register(layout.StaffGroup)
 class StaffGroupHandler(ElementHandler):
-    handles = layout.StaffGroup
+    __slots__ = ()
     insert = True
+    _PROPERTIES = ("symbol", "barTogether", "connectsAtTop", "connectsAtBottom")
 
-    def generate_code(self, element, name: str) -> str:
-        code_lines = [f"{name} = {self.get_hcls()}()"]
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        code_lines.append(f"{name} = {self._hcls_str}()")
 
-        for prop in "symbol barTogether connectsAtTop connectsAtBottom".split():
-            value = getattr(element, prop, None)
-            if value is not None:
-                value_str = f"'{value}'" if isinstance(value, str) else str(value)
-                code_lines.append(f"{name}.{prop} = {value_str}")
+        code_lines.extend(
+            f"{name}.{prop} = {value!r}"
+            for prop in self._PROPERTIES
+            if (value := getattr(element, prop, None)) is not None
+        )
 
         code_lines.extend(
-            f"{name}.addSpannedElements(generated_parts['{element.id}'])"
-            for element in element.getSpannedElements()
+            f"{name}.addSpannedElements(generated_parts['{spanned.id}'])"
+            for spanned in element.getSpannedElements()
         )
-        return "\n".join(code_lines)
 
 
 class ContainerHandler(ElementHandler):
-    def generate_code(self, element, name: str) -> str:
-        code_lines = [f"{name} = stream.{self.handles.__qualname__}()"]
-        prefix = self.handles.__qualname__.lower()
-        for i, sub_element in enumerate(element):
-            if not (handler := ElementHandler.get_handler(sub_element)):
-                raise NotImplementedError(
-                    dedent(
-                        f"""
-
-                    No handler implemented for sub-element type {type(sub_element)} in {self.handles.__qualname__}.
-
-                    Go ahead and contribute class {type(sub_element).__name__}Handler(ElementHandler)!
-
-                 """
-                    )
-                )
-            element_code = handler.generate_code(sub_element, f"{prefix}_e{i}")
-            code_lines.extend(element_code.split("\n"))
-            if hasattr(handler, "insert") and handler.insert:
-                code_lines.append(f"{name}.insert(0, {prefix}_e{i})")
+    __slots__ = ()
+
+    @classmethod
+    def registered(cls) -> None:
+        cls._constructor = f"stream.{cls.handles.__qualname__}()"
+        cls._prefix = cls.handles.__qualname__.lower()  # names the sub-elements
+
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
+        append = code_lines.append
+        append(f"{name} = {self._constructor}")
+        prefix = self._prefix
+        # resolve all handlers up front, the loop below then only touches locals
+        sub_elements = list(element)
+        handlers = list(map(ElementHandler.get_handler, sub_elements))
+        for i, (sub_element, handler) in enumerate(zip(sub_elements, handlers)):
+            if not handler:
+                raise _no_handler_error(sub_element, self.handles.__qualname__)
+            sub_name = f"{prefix}_e{i}"
+            handler.generate_code(sub_element, sub_name, code_lines, ctx)
+            if handler.insert:
+                append(f"{name}.insert(0, {sub_name})")
             else:
-                code_lines.append(f"{name}.append({prefix}_e{i})")
+                append(f"{name}.append({sub_name})")
         if ct := self.custom_treatment(element, name):
             code_lines.extend(ct)
-        return "\n".join(code_lines)
 
     def custom_treatment(self, element, name: str) -> list[str]:
         return []
 
 
+@register(stream.Part)
 class PartHandler(ContainerHandler):
-    handles = stream.Part
+    __slots__ = ()
 
     def custom_treatment(self, element, name: str) -> list[str]:
         return [
             f"generated_parts['{element.id}'] = {name}",
-            f"{name}.partName = '{element.partName}'",
-            f"{name}.partAbbreviation = '{element.partAbbreviation}'",
+            f"{name}.partName = {str(element.partName)!r}",
+            f"{name}.partAbbreviation = {str(element.partAbbreviation)!r}",
         ]
 
 
+@register(stream.Measure)
 class MeasureHandler(ContainerHandler):
-    handles = stream.Measure
+    __slots__ = ()
 
     def custom_treatment(self, element, name: str) -> list[str]:
         return [
@@ -427,14 +538,17 @@ class MeasureHandler(ContainerHandler):
         ]
 
 
+@register(stream.Score)
 class ScoreHandler(ContainerHandler):
-    handles = stream.Score
+    __slots__ = ()
 
 
+@register(stream.Stream)
 class StreamHandler(ContainerHandler):
-    handles = stream.Stream
+    __slots__ = ()
 
 
+@register(expressions.RehearsalMark)
 class RehearsalMarkHandler(ElementHandler):
     # TODO:
     #
@@ -460,22 +574,21 @@ class RehearsalMarkHandler(ElementHandler):
     # I don't know how to get at that enclosing direction element from the rehearsal
     # mark.
 
-    handles = expressions.RehearsalMark
+    __slots__ = ()
     insert = True
-
-    def get_properties(self) -> list[str]:
-        return "content".split()
+    _PROPERTIES = ("content",)
 
 
+@register(bar.Repeat)
 class RepeatHandler(ElementHandler):
-    handles = bar.Repeat
+    __slots__ = ()
 
     def get_params(self, element):
         params = []
 
         # Handle direction of the repeat (start or end)
-        if hasattr(element, "direction"):
-            params.append(f"direction='{element.direction}'")
+        if (direction := getattr(element, "direction", _MISS)) is not _MISS:
+            params.append(f"direction='{direction}'")
 
         # Add other attributes as needed based on the properties of the Repeat
         # ...
@@ -483,45 +596,45 @@ class RepeatHandler(ElementHandler):
         return ", ".join(params)
 
 
+@register(spanner.Slur)
 class SlurHandler(ElementHandler):
-    handles = spanner.Slur
+    __slots__ = ()
     insert = True
 
-    def generate_code(self, element, name: str) -> str:
-        global resolve_spanners
+    def generate_code(
+        self, element, name: str, code_lines: list[str], ctx: CodegenContext
+    ) -> None:
         params = self.get_params(element)
         # The Notes we're referring to here are only generated later, so we need store the code to resolve the spanners
         # to be executed at the end.
         # To keep the reference to the right spanner (Slur), we store it under the id of its first note. This should be
         # unique. We could have used the id of the freshly generated slur, too.
-        resolve_spanners += dedent(
-            f"""
-            generated_spanners['{element.getFirst().id}'].addSpannedElements(generated_notes['{element.getFirst().id}'])
-            generated_spanners['{element.getFirst().id}'].addSpannedElements(generated_notes['{element.getLast().id}'])
-        """
+        first_id = element.getFirst().id
+        last_id = element.getLast().id
+        ctx.resolve_lines.append(
+            f"generated_spanners['{first_id}'].addSpannedElements(generated_notes['{first_id}'])"
         )
-        return dedent(
-            f"""
-            {name} = {self.get_hcls()}({params})
-            generated_spanners['{element.getFirst().id}'] = {name}
-        """
+        ctx.resolve_lines.append(
+            f"generated_spanners['{first_id}'].addSpannedElements(generated_notes['{last_id}'])"
         )
+        code_lines.append(f"{name} = {self._hcls_str}({params})")
+        code_lines.append(f"generated_spanners['{first_id}'] = {name}")
 
     def get_params(self, element):
         params = []
 
         # Handle the type of the slur (start or stop)
         # MusicXML 'type' attribute maps to Slur's start/stop methods in music21
-        if hasattr(element, "type"):
-            params.append(f"type='{element.type}'")
+        if (slur_type := getattr(element, "type", _MISS)) is not _MISS:
+            params.append(f"type='{slur_type}'")
 
         # Handle the placement of the slur (above or below)
-        if hasattr(element, "placement"):
-            params.append(f"placement='{element.placement}'")
+        if (placement := getattr(element, "placement", _MISS)) is not _MISS:
+            params.append(f"placement='{placement}'")
 
         # Handle the number attribute (if used for identifying slurs in MusicXML)
-        if hasattr(element, "number"):
-            params.append(f"number={element.number}")
+        if (number := getattr(element, "number", _MISS)) is not _MISS:
+            params.append(f"number={number}")
 
         # Add other attributes as needed based on the properties of the Slur
         # ...
@@ -529,24 +642,50 @@ class SlurHandler(ElementHandler):
         return ", ".join(params)
 
 
+@register(note.Unpitched)
 class UnpitchedHandler(ElementHandler):
-    handles = note.Unpitched
+    __slots__ = ()
+    _PROPERTIES = ("displayStep", "displayOctave")
 
-    def get_properties(self) -> list[str]:
-        return "displayStep displayOctave".split()
 
+# Only the placeholders are filled in per call.
+_BOILERPLATE = r"""
 
-def generate_code_for_music_structure(
+if not {score_name}.isWellFormedNotation():
+    print("The score is not well-formed. Check the structure and contents.")
+    {score_name}.show("text")
+
+
+file_path = "{musicxml_out_fn}"
+print(f"Saved to \"{musicxml_out_fn}\"")
+{score_name}.write("musicxml", fp=file_path)
+import subprocess
+subprocess.run(f"open {musicxml_out_fn}".split())
+"""
+
+
+def _header_lines(omit_boilerplate: bool, origin) -> list[str]:
+    return [
+        "from music21 import *",
+        "",
+        f"# generated by {_MODULE_NAME} {datetime.now()} {f'from {origin}' if origin else ''}",
+        f"# {'without' if omit_boilerplate else 'with'} boilerplate.",
+    ]
+
+
+def generate_code_lines(
     music_structure,
     omit_boilerplate=False,
     musicxml_out_fn="output.musicxml",
     origin=None,
-):
+) -> list[str]:
+    """
+    Like generate_code_for_music_structure, but returns the generated code as a
+    list of lines, which callers writing to a file or stdout can output without
+    joining them into one big string first.
+    """
     code_lines = [
-        "from music21 import *",
-        "",
-        f"# generated by {P(__file__).name} {datetime.now()} {f'from {origin}' if origin else ''}",
-        f"# {'without' if omit_boilerplate else 'with'} boilerplate.",
+        *_header_lines(omit_boilerplate, origin),
         "",
         "generated_parts = dict()",
         "generated_notes = dict()",
@@ -555,50 +694,93 @@ def generate_code_for_music_structure(
     ]
 
     if not (handler := ElementHandler.get_handler(music_structure)):
-        raise NotImplementedError(
-            dedent(
-                f"""
+        raise _no_handler_error(music_structure, "MusicStructure")
 
-            No handler implemented for sub-element type {type(music_structure)} in MusicStructure.
-
-            Go ahead and contribute class {type(music_structure).__name__}Handler(ElementHandler)!
-
-         """
-            )
-        )
+    ctx = CodegenContext()
+    handler.generate_code(music_structure, f"{SCORE_NAME}", code_lines, ctx)
+    code_lines.append('last_measure.rightBarline = bar.Barline(type="final")')
+    code_lines.extend(ctx.resolve_lines)
 
-    element_code = handler.generate_code(music_structure, f"{SCORE_NAME}")
-    code_lines.extend(element_code.split("\n"))
-    code_lines.append(
-        dedent(
-            """
-            last_measure.rightBarline = bar.Barline(type="final")
-            """
+    if not omit_boilerplate:
+        boilerplate = _BOILERPLATE.format(
+            score_name=SCORE_NAME, musicxml_out_fn=musicxml_out_fn
         )
-    )
+        code_lines.extend(boilerplate.split("\n"))
 
-    code_str = "\n".join(code_lines)
+    return code_lines
 
-    code_str += resolve_spanners
 
-    if not omit_boilerplate:
-        code_str += dedent(
-            rf"""
+def generate_code_for_music_structure(
+    music_structure,
+    omit_boilerplate=False,
+    musicxml_out_fn="output.musicxml",
+    origin=None,
+):
+    return "\n".join(
+        generate_code_lines(music_structure, omit_boilerplate, musicxml_out_fn, origin)
+    )
 
-        if not {SCORE_NAME}.isWellFormedNotation():
-            print("The score is not well-formed. Check the structure and contents.")
-            {SCORE_NAME}.show("text")
 
+def _cache_path(musicxml_file_path: str, *options) -> P | None:
+    """
+    Path of the cached generated code for the musicxml file, keyed by the contents
+    and path of the musicxml file (the generated code refers to it), the options
+    given, and the versions of music21 and of this generator, so that a change to
+    any of them invalidates the cache. None if there is no cache directory, or if
+    the input is not a readable file (converter.parse also accepts e.g. URLs and
+    tinyNotation, and reports unreadable files itself).
+    """
+    try:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or P.home() / ".cache"
+        musicxml = P(musicxml_file_path).read_bytes()
+    except (KeyError, RuntimeError):  # no home directory to be found
+        return None
+    except (OSError, ValueError):  # not a local file
+        return None
+    h = hashlib.sha256(musicxml)
+    h.update(P(__file__).read_bytes())
+    h.update(repr((musicxml_file_path, music21.VERSION_STR, *options)).encode())
+    return P(cache_home) / "m21gen" / f"{h.hexdigest()}.py"
 
-        file_path = "{musicxml_out_fn}"
-        print(f"Saved to \"{musicxml_out_fn}\"")
-        {SCORE_NAME}.write("musicxml", fp=file_path)
-        import subprocess
-        subprocess.run(f"open {musicxml_out_fn}".split())
-        """
-        )
 
-    return code_str
+def _read_cache(path: P) -> str | None:
+    try:
+        code = path.read_text()
+    except OSError:
+        return None
+    with suppress(OSError):
+        path.touch()  # mark as recently used, see _prune_cache
+    return code
+
+
+def _prune_cache(cache_dir: P) -> None:
+    """
+    Keeps the _CACHE_ENTRIES most recently used entries, older ones are left over
+    from edited musicxml files or previous versions of this generator.
+    """
+    entries = sorted(
+        cache_dir.glob("*.py"), key=lambda entry: entry.stat().st_mtime, reverse=True
+    )
+    for entry in entries[_CACHE_ENTRIES:]:
+        entry.unlink(missing_ok=True)
+
+
+def _write_cache(path: P, code_lines: list[str]) -> None:
+    """
+    Caching is best effort: the code has already been output, so failing to write
+    the cache (read-only or full disk, cache home not a directory, ...) is ignored.
+    """
+    # write to a temporary file first, so readers never see a partial file
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w") as f:
+            print(*code_lines, sep="\n", file=f)
+        os.replace(tmp, path)
+        _prune_cache(path.parent)
+    except OSError:
+        with suppress(OSError):
+            tmp.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
@@ -629,6 +811,9 @@ if __name__ == "__main__":
         omit_boilerplate: bool = typer.Option(
             False, "--omit-boilerplate", "-n", help="Omit boilerplate code"
         ),
+        no_cache: bool = typer.Option(
+            False, "--no-cache", help="Neither read nor write the generated code cache"
+        ),
         display_m21_structure: bool = typer.Option(
             False,
             "--display-m21-structure",
@@ -639,6 +824,17 @@ if __name__ == "__main__":
             ..., help="Path to musicxml file", show_default=False
         ),
     ):
+        # parsing is the expensive part, skip it when regenerating an unchanged file
+        cached = None
+        if not (no_cache or display_m21_structure):
+            cached = _cache_path(musicxml_file_path, omit_boilerplate)
+            if cached and (cached_code := _read_cache(cached)) is not None:
+                # the cache holds the code after the header, which is generated anew
+                print("#!/usr/bin/env python\n")
+                print(*_header_lines(omit_boilerplate, musicxml_file_path), sep="\n")
+                print(cached_code, end="")
+                return
+
         score = converter.parse(musicxml_file_path)
 
         if display_m21_structure:
@@ -646,13 +842,17 @@ if __name__ == "__main__":
 
         print("#!/usr/bin/env python\n")
         musicxml_out_fn = f"{P(musicxml_file_path).stem}_generated.musicxml"
-        generated_code = generate_code_for_music_structure(
+        code_lines = generate_code_lines(
             score,
             omit_boilerplate=omit_boilerplate,
             musicxml_out_fn=musicxml_out_fn,
             origin=musicxml_file_path,
         )
-        print(generated_code)
+        print(*code_lines, sep="\n")
+
+        if cached:
+            header = _header_lines(omit_boilerplate, musicxml_file_path)
+            _write_cache(cached, code_lines[len(header) :])
 
     custom_help_check()
     typer.run(main)
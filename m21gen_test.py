@@ -1,8 +1,31 @@
 # test_music_script.py
 
-from music21 import chord, note, stream
+import os
+from fractions import Fraction
 
-from m21gen import generate_code_for_music_structure
+import pytest
+from music21 import (
+    chord,
+    dynamics,
+    expressions,
+    layout,
+    metadata,
+    note,
+    spanner,
+    stream,
+)
+
+from m21gen import (
+    _CACHE_ENTRIES,
+    ElementHandler,
+    _cache_path,
+    _prune_cache,
+    _read_cache,
+    _write_cache,
+    generate_code_for_music_structure,
+    generate_code_lines,
+    register,
+)
 
 
 def test_generate_code_for_note():
@@ -17,3 +40,138 @@ def test_generate_code_for_chord():
     s.append(chord.Chord(["E4", "G4"]))
     generated_code = generate_code_for_music_structure(s)
     assert "chord.Chord(['E4', 'G4'" in generated_code
+
+
+def test_register_custom_handler():
+    s = stream.Stream()
+    s.append(dynamics.Dynamic("ff"))
+    with pytest.raises(NotImplementedError):
+        generate_code_for_music_structure(s)
+
+    @register(dynamics.Dynamic)
+    class DynamicHandler(ElementHandler):
+        def get_params(self, element) -> str:
+            return f"'{element.value}'"
+
+    try:
+        generated_code = generate_code_for_music_structure(s)
+        assert "dynamics.Dynamic('ff')" in generated_code
+    finally:
+        del ElementHandler._handlers[dynamics.Dynamic]
+        ElementHandler._resolved.clear()
+
+
+def test_generate_code_escapes_quotes():
+    s = stream.Score()
+    s.insert(0, metadata.Metadata(title="L'Isle joyeuse"))
+    p = stream.Part()
+    m = stream.Measure(number=1)
+    m.append(expressions.TextExpression('it\'s \\ "quoted"'))
+    n = note.Note("C4")
+    n.lyric = "don't\nstop'''"
+    m.append(n)
+    p.append(m)
+    s.insert(0, p)
+    generated_code = generate_code_for_music_structure(s, omit_boilerplate=True)
+    local_variables = {}
+    exec(generated_code, {}, local_variables)
+    score = local_variables["score"]
+    assert score.metadata.title == "L'Isle joyeuse"
+    (te,) = score.recurse().getElementsByClass(expressions.TextExpression)
+    assert te.content == 'it\'s \\ "quoted"'
+    (n,) = score.recurse().notes
+    assert n.lyric == "don't\nstop'''"
+
+
+def test_generate_code_keeps_tuplet_durations():
+    s = stream.Measure(number=1)
+    s.append(note.Note("C4", quarterLength=Fraction(1, 3)))
+    s.append(chord.Chord(["E4", "G4"], quarterLength=Fraction(2, 3)))
+    s.append(note.Rest(quarterLength=Fraction(1, 6)))
+    generated_code = generate_code_for_music_structure(s, omit_boilerplate=True)
+    assert "Fraction" not in generated_code
+    local_variables = {}
+    exec(generated_code, {}, local_variables)
+    durations = [e.quarterLength for e in local_variables["score"].notesAndRests]
+    assert durations == [Fraction(1, 3), Fraction(2, 3), Fraction(1, 6)]
+
+
+def test_generate_code_resolves_spanners_per_call():
+    m = stream.Measure(number=1)
+    n1, n2 = note.Note("C4"), note.Note("D4")
+    m.append([n1, n2])
+    m.insert(0, spanner.Slur(n1, n2))
+    for _ in range(2):
+        generated_code = generate_code_for_music_structure(m, omit_boilerplate=True)
+        assert generated_code.count(".addSpannedElements(") == 2
+
+
+def test_generate_code_lines_are_single_lines():
+    s = stream.Measure(number=1)
+    n = note.Note("C4")
+    n.lyric = "two\nlines"
+    s.append(n)
+    code_lines = generate_code_lines(s)
+    assert 'subprocess.run(f"open output.musicxml".split())' in code_lines
+    assert not [line for line in code_lines if "\n" in line]
+
+
+def test_generate_code_keeps_page_layout_output():
+    # Pins the output from before the comprehension rewrite, not a contract:
+    # PageLayout happens to convert the quoted value back to a number.
+    s = stream.Measure(number=1)
+    s.append(layout.PageLayout(leftMargin=72.0))
+    generated_code = generate_code_for_music_structure(s, omit_boilerplate=True)
+    assert ".leftMargin='72.0'" in generated_code
+
+
+def test_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    musicxml = tmp_path / "score.musicxml"
+    musicxml.write_text("<score-partwise/>")
+    path = _cache_path(str(musicxml), False)
+    assert path.parent == tmp_path / "cache" / "m21gen"
+    assert _read_cache(path) is None
+    _write_cache(path, ["line 1", "line 2"])
+    assert _read_cache(path) == "line 1\nline 2\n"
+    assert _cache_path(str(musicxml), True) != path
+    musicxml.write_text("<score-timewise/>")
+    assert _cache_path(str(musicxml), False) != path
+
+
+def test_cache_write_failure_is_ignored(tmp_path, monkeypatch):
+    not_a_dir = tmp_path / "file"
+    not_a_dir.write_text("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(not_a_dir))
+    musicxml = tmp_path / "score.musicxml"
+    musicxml.write_text("<score-partwise/>")
+    path = _cache_path(str(musicxml), False)
+    _write_cache(path, ["line 1"])
+    assert _read_cache(path) is None
+    assert sorted(tmp_path.iterdir()) == [not_a_dir, musicxml]
+
+
+def test_cache_write_failure_removes_temporary_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    musicxml = tmp_path / "score.musicxml"
+    musicxml.write_text("<score-partwise/>")
+    path = _cache_path(str(musicxml), False)
+    path.mkdir(parents=True)  # os.replace can't overwrite a directory
+    _write_cache(path, ["line 1"])
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_cache_path_is_none_for_non_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    assert _cache_path("tinyNotation: 4/4 c4 d e f", False) is None
+    assert _cache_path(str(tmp_path / "missing.musicxml"), False) is None
+    assert _cache_path(str(tmp_path), False) is None
+
+
+def test_prune_cache_keeps_most_recent_entries(tmp_path):
+    entries = [tmp_path / f"{i}.py" for i in range(_CACHE_ENTRIES + 2)]
+    for i, entry in enumerate(entries):
+        entry.write_text("")
+        os.utime(entry, (i, i))
+    _prune_cache(tmp_path)
+    assert sorted(tmp_path.iterdir()) == sorted(entries[2:])